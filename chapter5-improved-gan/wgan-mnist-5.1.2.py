@@ -19,125 +19,172 @@ from __future__ import print_function
 
 from tensorflow.keras.layers import Input
 from tensorflow.keras.optimizers import RMSprop
-from tensorflow.keras.models import Model
 from tensorflow.keras.datasets import mnist
 from tensorflow.keras import backend as K
 from tensorflow.keras.models import load_model
+from tensorflow.keras import mixed_precision
 
+import tensorflow as tf
 import numpy as np
 import argparse
+import os
+import tempfile
 
 import sys
 sys.path.append("..")
 from lib import gan
 
-def train(models, x_train, params):
-    """Train the Discriminator and Adversarial Networks
+def train(models, optimizers, dataset, params):
+    """Train the Discriminator and Generator Networks
 
-    Alternately train Discriminator and Adversarial
+    Alternately train Discriminator and Generator
     networks by batch.
-    Discriminator is trained first with properly labelled
-    real and fake images for n_critic times.
+    Discriminator is trained first (d_step) with properly 
+    labelled real and fake images for n_critic times.
     Discriminator weights are clipped as a requirement 
-    of Lipschitz constraint.
-    Generator is trained next (via Adversarial) with 
-    fake images pretending to be real.
-    Generate sample images per save_interval
+    of Lipschitz constraint by the weight constraints
+    attached to the discriminator layers.
+    Generator is trained next (g_step) with fake images 
+    pretending to be real. The loss is computed through 
+    the discriminator but only the generator weights are 
+    updated.
+    Each training step is an XLA compiled tf.function so the
+    fake images stay on the device.
+    Losses are accumulated on the device and
+    logged per save_interval together with sample images
 
     Arguments:
-        models (list): Generator, Discriminator,
-            Adversarial models
-        x_train (tensor): Train images
+        models (list): Generator, Discriminator models
+        optimizers (list): Discriminator, Generator optimizers
+        dataset (Dataset): Infinite dataset of fixed size batches
+            of uint8 train images
         params (list) : Networks parameters
 
     """
     # the GAN models
-    generator, discriminator, adversarial = models
+    generator, discriminator = models
+    # each network has its own optimizer state
+    d_optimizer, g_optimizer = optimizers
     # network parameters
-    (batch_size, latent_size, n_critic, 
-            clip_value, train_steps, model_name) = params
+    batch_size, latent_size, n_critic, train_steps, model_name = params
     # the generator image is saved every 500 steps
     save_interval = 500
     # noise vector to see how the 
     # generator output evolves during training
+    # kept as a constant on the device since it never changes
     noise_input = np.random.uniform(-1.0,
                                     1.0, 
                                     size=[16, latent_size])
-    # number of elements in train dataset
-    train_size = x_train.shape[0]
-    # labels for real data
-    real_labels = np.ones((batch_size, 1))
+    noise_input = tf.constant(noise_input.astype(np.float32))
+    # real images are fetched from the prefetching pipeline
+    real_iter = iter(dataset)
+    # labels for real and fake data are constant,
+    # so they are created once outside the train loop
+    real_labels = np.ones((batch_size, 1), dtype=np.float32)
+    fake_labels = -real_labels
+    # sums of losses stay on the device until logged
+    # to avoid a device to host sync per train step.
+    # accuracy is not tracked since the WGAN discriminator
+    # output is linear, not a probability
+    d_loss_sum = tf.Variable(0.0, trainable=False)
+    g_loss_sum = tf.Variable(0.0, trainable=False)
+
+    # the train steps are XLA compiled to fuse the small
+    # MNIST sized kernels and reduce kernel launches.
+    # the input signature fixes the batch of real images to
+    # (batch_size, 28, 28, 1) uint8 so the steps are traced
+    # once and specialized for that shape
+    real_spec = dataset.element_spec
+
+    def d_update(images, labels):
+        """Update the discriminator on 1 batch. Return the loss."""
+        with tf.GradientTape() as tape:
+            pred = discriminator(images, training=True)
+            loss = wasserstein_loss(labels, pred)
+            # scale the loss to prevent float16 gradient underflow
+            scaled_loss = get_scaled_loss(d_optimizer, loss)
+        variables = discriminator.trainable_variables
+        grads = tape.gradient(scaled_loss, variables)
+        grads = get_unscaled_gradients(d_optimizer, grads)
+        d_optimizer.apply_gradients(zip(grads, variables))
+        return loss
+
+    @tf.function(jit_compile=True, input_signature=[real_spec])
+    def d_step(real_images):
+        """Train the discriminator for 1 batch of real and
+        1 batch of fake images. Accumulate the loss.
+        """
+        # normalize the uint8 real images on the device
+        real_images = tf.cast(real_images, tf.float32) / 255.0
+        # generate noise on the device using uniform distribution
+        noise = tf.random.uniform((batch_size, latent_size),
+                                  -1.0,
+                                  1.0)
+        # generate fake images from noise using generator
+        # same as generator.predict(). the generator weights are
+        # not updated since only the discriminator variables
+        # are passed to d_optimizer
+        fake_images = generator(noise, training=False)
+        # real data label=1, fake data label=-1
+        # instead of 1 combined batch of real and fake images,
+        # train with 1 batch of real data first, then 1 batch
+        # of fake images.
+        # this tweak prevents the gradient 
+        # from vanishing due to opposite
+        # signs of real and fake data labels (i.e. +1 and -1) and 
+        # small magnitude of weights due to clipping.
+        real_loss = d_update(real_images, real_labels)
+        fake_loss = d_update(fake_images, fake_labels)
+        # accumulate average loss
+        d_loss_sum.assign_add(0.5 * (real_loss + fake_loss))
+
+    @tf.function(jit_compile=True, input_signature=[])
+    def g_step():
+        """Train the generator through the discriminator
+        for 1 batch of fake images. Accumulate the loss.
+        """
+        # generate noise on the device using uniform distribution
+        noise = tf.random.uniform((batch_size, latent_size),
+                                  -1.0,
+                                  1.0)
+        with tf.GradientTape() as tape:
+            fake_images = generator(noise, training=True)
+            fake_pred = discriminator(fake_images, training=True)
+            # fake images are labelled as real
+            loss = wasserstein_loss(real_labels, fake_pred)
+            scaled_loss = get_scaled_loss(g_optimizer, loss)
+        # only the generator variables are passed to g_optimizer
+        # so the discriminator weights are not updated
+        variables = generator.trainable_variables
+        grads = tape.gradient(scaled_loss, variables)
+        grads = get_unscaled_gradients(g_optimizer, grads)
+        g_optimizer.apply_gradients(zip(grads, variables))
+        g_loss_sum.assign_add(loss)
+
     for i in range(train_steps):
         # train discriminator n_critic times
-        loss = 0
-        acc = 0
         for _ in range(n_critic):
             # train the discriminator for 1 batch
             # 1 batch of real (label=1.0) and 
             # fake images (label=-1.0)
-            # randomly pick real images from dataset
-            rand_indexes = np.random.randint(0,
-                                             train_size, 
-                                             size=batch_size)
-            real_images = x_train[rand_indexes]
-            # generate fake images from noise using generator
-            # generate noise using uniform distribution
-            noise = np.random.uniform(-1.0,
-                                      1.0,
-                                      size=[batch_size, latent_size])
-            fake_images = generator.predict(noise)
-
-            # train the discriminator network
-            # real data label=1, fake data label=-1
-            # instead of 1 combined batch of real and fake images,
-            # train with 1 batch of real data first, then 1 batch
-            # of fake images.
-            # this tweak prevents the gradient 
-            # from vanishing due to opposite
-            # signs of real and fake data labels (i.e. +1 and -1) and 
-            # small magnitude of weights due to clipping.
-            real_loss, real_acc = \
-                discriminator.train_on_batch(real_images,
-                                             real_labels)
-            fake_loss, fake_acc = \
-                discriminator.train_on_batch(fake_images,
-                                             -real_labels)
-            # accumulate average loss and accuracy
-            loss += 0.5 * (real_loss + fake_loss)
-            acc += 0.5 * (real_acc + fake_acc)
-
-            # clip discriminator weights to satisfy Lipschitz constraint
-            for layer in discriminator.layers:
-                weights = layer.get_weights()
-                weights = [np.clip(weight,
-                                   -clip_value,
-                                   clip_value) for weight in weights]
-                layer.set_weights(weights)
-
-        # average loss and accuracy per n_critic training iterations
-        loss /= n_critic
-        acc /= n_critic
-        log = "%d: [discriminator loss: %f, acc: %f]" % (i, loss, acc)
-
-        # train the adversarial network for 1 batch
+            # next shuffled batch of real images from dataset
+            real_images = next(real_iter)
+            d_step(real_images)
+
+        # train the generator for 1 batch
         # 1 batch of fake images with label=1.0
-        # since the discriminator weights are frozen in 
-        # adversarial network only the generator is trained
-        # generate noise using uniform distribution
-        noise = np.random.uniform(-1.0,
-                                  1.0,
-                                  size=[batch_size, latent_size])
-        # train the adversarial network
-        # note that unlike in discriminator training,
-        # we do not save the fake images in a variable
-        # the fake images go to the discriminator 
-        # input of the adversarial for classification
-        # fake images are labelled as real
-        # log the loss and accuracy
-        loss, acc = adversarial.train_on_batch(noise, real_labels)
-        log = "%s [adversarial loss: %f, acc: %f]" % (log, loss, acc)
-        print(log)
+        g_step()
         if (i + 1) % save_interval == 0:
+            # read the sums back once per save_interval
+            # average loss per n_critic and
+            # save_interval training iterations
+            d_loss = d_loss_sum.numpy() / (n_critic * save_interval)
+            g_loss = g_loss_sum.numpy() / save_interval
+            d_loss_sum.assign(0.0)
+            g_loss_sum.assign(0.0)
+            log = "%d: [discriminator loss: %f]" % (i, d_loss)
+            log = "%s [generator loss: %f]" % (log, g_loss)
+            print(log)
             # plot generator images on a periodic basis
             gan.plot_images(generator,
                             noise_input=noise_input,
@@ -155,20 +202,104 @@ def wasserstein_loss(y_label, y_pred):
     return -K.mean(y_label * y_pred)
 
 
+def get_scaled_loss(optimizer, loss):
+    """Scale the loss if the optimizer uses loss scaling
+    (mixed precision). Otherwise return the loss as is.
+    """
+    if isinstance(optimizer, mixed_precision.LossScaleOptimizer):
+        return optimizer.get_scaled_loss(loss)
+    return loss
+
+
+def get_unscaled_gradients(optimizer, grads):
+    """Unscale the gradients if the optimizer uses loss scaling
+    (mixed precision). Otherwise return the gradients as is.
+    """
+    if isinstance(optimizer, mixed_precision.LossScaleOptimizer):
+        return optimizer.get_unscaled_gradients(grads)
+    return grads
+
+
+def memmap_images(images, filename):
+    """Save images once in the Keras datasets cache directory
+    and return them as a read-only memory map
+
+    The cache directory is the one used by mnist.load_data():
+    $KERAS_HOME or ~/.keras, or /tmp/.keras if not writable.
+    If no cache file can be written, the images are returned
+    unchanged and stay in memory.
+
+    Arguments:
+        images (ndarray): Images to cache
+        filename (string): Name of the .npy cache file
+
+    Returns:
+        memmap: Read-only memory map of the cached images
+    """
+    keras_home = os.environ.get('KERAS_HOME',
+                                os.path.join(os.path.expanduser('~'),
+                                             '.keras'))
+    if not os.access(keras_home, os.W_OK):
+        keras_home = os.path.join('/tmp', '.keras')
+    cache_dir = os.path.join(keras_home, 'datasets')
+    path = os.path.join(cache_dir, filename)
+    if os.path.isfile(path):
+        try:
+            cached = np.load(path, mmap_mode='r')
+            if cached.shape == images.shape \
+                    and cached.dtype == images.dtype:
+                return cached
+        except (ValueError, OSError):
+            # truncated or corrupted cache file is rewritten
+            pass
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.npy', dir=cache_dir)
+    except OSError:
+        # no writable cache directory, keep the images in memory
+        return images
+
+    # save to a temp file then rename so an interrupted save
+    # never leaves a truncated cache file behind
+    try:
+        try:
+            f = os.fdopen(fd, 'wb')
+        except BaseException:
+            os.close(fd)
+            raise
+        with f:
+            np.save(f, images)
+        os.replace(tmp_path, path)
+    except OSError:
+        # e.g. disk full, keep the images in memory
+        os.remove(tmp_path)
+        return images
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return np.load(path, mmap_mode='r')
+
+
 def build_and_train_models():
-    """Load the dataset, build WGAN discriminator,
-    generator, and adversarial models.
+    """Load the dataset, build WGAN discriminator
+    and generator models.
     Call the WGAN train routine.
     """
     # load MNIST dataset
     (x_train, _), (_, _) = mnist.load_data()
 
-    # reshape data for CNN as (28, 28, 1) and normalize
+    # reshape data for CNN as (28, 28, 1)
+    # images are kept as uint8 on the host and normalized 
+    # on the device by the discriminator train step
     image_size = x_train.shape[1]
     x_train = np.reshape(x_train, [-1, image_size, image_size, 1])
-    x_train = x_train.astype('float32') / 255
 
     model_name = "wgan_mnist"
+    # the uint8 images are saved once and memory mapped so only 
+    # the pages of the sampled batches need to be resident
+    x_train = memmap_images(x_train, "mnist_train.npy")
+    train_size = x_train.shape[0]
     # network parameters
     # the latent or z vector is 100-dim
     latent_size = 100
@@ -180,15 +311,20 @@ def build_and_train_models():
     train_steps = 40000
     input_shape = (image_size, image_size, 1)
 
+    # mixed precision is only faster on GPU, float16 is slow on CPU
+    use_gpu = len(tf.config.list_physical_devices('GPU')) > 0
+    if use_gpu:
+        # compute in float16 while keeping float32 weights
+        # the network outputs and the losses remain in float32
+        mixed_precision.set_global_policy('mixed_float16')
+
     # build discriminator model
     inputs = Input(shape=input_shape, name='discriminator_input')
     # WGAN uses linear activation in paper [2]
-    discriminator = gan.discriminator(inputs, activation='linear')
-    optimizer = RMSprop(lr=lr)
-    # WGAN discriminator uses wassertein loss
-    discriminator.compile(loss=wasserstein_loss,
-                          optimizer=optimizer,
-                          metrics=['accuracy'])
+    # discriminator weights are clipped to satisfy Lipschitz constraint
+    discriminator = gan.discriminator(inputs,
+                                      activation='linear',
+                                      clip_value=clip_value)
     discriminator.summary()
 
     # build generator model
@@ -197,26 +333,55 @@ def build_and_train_models():
     generator = gan.generator(inputs, image_size)
     generator.summary()
 
-    # build adversarial model = generator + discriminator
-    # freeze the weights of discriminator during adversarial training
-    discriminator.trainable = False
-    adversarial = Model(inputs,
-                        discriminator(generator(inputs)),
-                        name=model_name)
-    adversarial.compile(loss=wasserstein_loss,
-                        optimizer=optimizer,
-                        metrics=['accuracy'])
-    adversarial.summary()
-
-    # train discriminator and adversarial networks
-    models = (generator, discriminator, adversarial)
+    # WGAN discriminator and generator use wassertein loss
+    # in the compiled train steps
+    # with mixed precision, loss scaling keeps small float16
+    # gradients from underflowing
+    # discriminator and generator have separate optimizers so
+    # slot variables and iterations are not shared
+    d_optimizer = RMSprop(learning_rate=lr)
+    g_optimizer = RMSprop(learning_rate=lr)
+    if use_gpu:
+        d_optimizer = mixed_precision.LossScaleOptimizer(d_optimizer)
+        g_optimizer = mixed_precision.LossScaleOptimizer(g_optimizer)
+    optimizers = (d_optimizer, g_optimizer)
+
+    # train discriminator and generator networks
+    models = (generator, discriminator)
     params = (batch_size,
               latent_size,
               n_critic,
-              clip_value,
               train_steps,
               model_name)
-    train(models, x_train, params)
+    def read_images(indexes):
+        """Read 1 batch of real images from the memory map"""
+        # sorted indexes read the memory map front to back
+        images = tf.numpy_function(lambda i: x_train[np.sort(i)],
+                                   [indexes],
+                                   tf.uint8)
+        images.set_shape((batch_size, ) + x_train.shape[1:])
+        return images
+
+    # shuffled indexes of real images are batched, then the images
+    # are read and prefetched in the background while the models
+    # are trained
+    dataset = tf.data.Dataset.range(train_size)
+    # every epoch is a new random permutation of all indexes so
+    # images are sampled without replacement.
+    # batching before repeat keeps every batch within 1 epoch.
+    # drop_remainder gives the batches a static shape and skips
+    # the last partial batch of the permutation
+    dataset = dataset.shuffle(train_size)
+    dataset = dataset.batch(batch_size, drop_remainder=True)
+    dataset = dataset.repeat()
+    dataset = dataset.map(read_images,
+                          num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.prefetch(tf.data.AUTOTUNE)
+    if use_gpu:
+        # copy the next batches to the GPU ahead of time
+        prefetch = tf.data.experimental.prefetch_to_device('/gpu:0')
+        dataset = dataset.apply(prefetch)
+    train(models, optimizers, dataset, params)
 
 
 if __name__ == '__main__':
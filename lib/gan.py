@@ -14,12 +14,35 @@ from tensorflow.keras.layers import LeakyReLU
 from tensorflow.keras.layers import BatchNormalization
 from tensorflow.keras.layers import concatenate
 from tensorflow.keras.models import Model
+from tensorflow.keras.constraints import Constraint
+from tensorflow.keras import backend as K
 
 import numpy as np
 import math
 import matplotlib.pyplot as plt
 import os
 
+
+class ClipConstraint(Constraint):
+    """Clip weights to [-clip_value, clip_value]
+
+    The constraint is applied by the optimizer right after 
+    each weight update so the clipping stays in the graph.
+    Used by WGAN to satisfy the Lipschitz constraint.
+
+    Arguments:
+        clip_value (float): Max absolute value of weights
+    """
+    def __init__(self, clip_value):
+        self.clip_value = clip_value
+
+    def __call__(self, weights):
+        return K.clip(weights, -self.clip_value, self.clip_value)
+
+    def get_config(self):
+        return {'clip_value': self.clip_value}
+
+
 def generator(inputs,
               image_size,
               activation='sigmoid',
@@ -84,7 +107,8 @@ def generator(inputs,
                             padding='same')(x)
 
     if activation is not None:
-        x = Activation(activation)(x)
+        # output is float32 even with mixed precision policy
+        x = Activation(activation, dtype='float32')(x)
 
     # generator output is the synthesized image x
     return Model(inputs, x, name='generator')
@@ -93,7 +117,8 @@ def generator(inputs,
 def discriminator(inputs,
                   activation='sigmoid',
                   num_labels=None,
-                  num_codes=None):
+                  num_codes=None,
+                  clip_value=None):
     """Build a Discriminator Model
 
     Stack of LeakyReLU-Conv2D to discriminate real from fake
@@ -106,6 +131,8 @@ def discriminator(inputs,
         num_labels (int): Dimension of one-hot labels for ACGAN & InfoGAN
         num_codes (int): num_codes-dim Q network as output 
                     if StackedGAN or 2 Q networks if InfoGAN
+        clip_value (float): If not None, clip Conv2D and 1st output
+                    weights to [-clip_value, clip_value] (WGAN)
                     
 
     Returns:
@@ -113,6 +140,10 @@ def discriminator(inputs,
     """
     kernel_size = 5
     layer_filters = [32, 64, 128, 256]
+    # WGAN weight clipping is done in-graph by the optimizer
+    constraint = None
+    if clip_value is not None:
+        constraint = ClipConstraint(clip_value)
 
     x = inputs
     for filters in layer_filters:
@@ -126,14 +157,20 @@ def discriminator(inputs,
         x = Conv2D(filters=filters,
                    kernel_size=kernel_size,
                    strides=strides,
-                   padding='same')(x)
+                   padding='same',
+                   kernel_constraint=constraint,
+                   bias_constraint=constraint)(x)
 
     x = Flatten()(x)
     # default output is probability that the image is real
-    outputs = Dense(1)(x)
+    # output is float32 even with mixed precision policy
+    outputs = Dense(1,
+                    kernel_constraint=constraint,
+                    bias_constraint=constraint,
+                    dtype='float32')(x)
     if activation is not None:
         print(activation)
-        outputs = Activation(activation)(outputs)
+        outputs = Activation(activation, dtype='float32')(outputs)
 
     if num_labels:
         # ACGAN and InfoGAN have 2nd output
@@ -263,7 +300,9 @@ def plot_images(generator,
     # Arguments
         generator (Model): The Generator Model for 
             fake images generation
-        noise_input (ndarray): Array of z-vectors
+        noise_input (ndarray or tensor): Array of z-vectors
+        noise_label (ndarray): One-hot labels (ACGAN, InfoGAN)
+        noise_codes (list): Disentangled codes (InfoGAN)
         show (bool): Whether to show plot or not
         step (int): Appended to filename of the save images
         model_name (string): Model name
@@ -277,20 +316,22 @@ def plot_images(generator,
         if noise_codes is not None:
             noise_input += noise_codes
 
-    images = generator.predict(noise_input)
-    plt.figure(figsize=(2.2, 2.2))
-    num_images = images.shape[0]
+    # a direct model call avoids the predict() loop overhead
+    images = generator(noise_input, training=False).numpy()
     image_size = images.shape[1]
-    for i in range(num_images):
-        plt.subplot(rows, rows, i + 1)
-        image = np.reshape(images[i], [image_size, image_size])
-        plt.imshow(image, cmap='gray')
-        plt.axis('off')
-    plt.savefig(filename)
+    # tile the images in a rows x rows grid with a single
+    # reshape and transpose instead of 1 subplot per image
+    grid = np.reshape(images, [rows, rows, image_size, image_size])
+    grid = grid.transpose(0, 2, 1, 3)
+    grid = np.reshape(grid, [rows * image_size, rows * image_size])
+    # sigmoid output is in [0, 1], fixed range instead of 
+    # rescaling the whole grid to its own min and max
+    plt.imsave(filename, grid, cmap='gray', vmin=0.0, vmax=1.0)
     if show:
+        plt.figure(figsize=(2.2, 2.2))
+        plt.imshow(grid, cmap='gray', vmin=0.0, vmax=1.0)
+        plt.axis('off')
         plt.show()
-    else:
-        plt.close('all')
 
 
 def test_generator(generator):